@@ -6,10 +6,14 @@ import tqdm
 import cv2
 import numpy as np
 
+import reader
+
 logging.basicConfig(
     level=logging.INFO, format="%(asctime)s - %(levelname)s - %(message)s"
 )
 
+CHUNK_SIZE = 8192
+
 if __name__ == "__main__":
     parser = argparse.ArgumentParser()
     parser.add_argument(
@@ -31,34 +35,50 @@ if __name__ == "__main__":
     arrs = np.load(input_file)
 
     frames_data = arrs["frame_data"]
-    polarities_data = arrs["polarity_data"]
     polarity_groups = arrs["polarity_groups"]
 
     logging.info(f"Loaded {input_file} successfully.")
     logging.info(f"Frames: {len(frames_data):>10}")
-    logging.info(f"Polarities: {len(polarities_data):>10}")
+    logging.info(f"Polarities: {len(polarity_groups):>10}")
 
     logging.info("Averaging polarities...")
-    averaged_polarities = []
-    for i in tqdm.tqdm(range(len(frames_data))):
-        mask = polarity_groups == i
-        if np.any(mask):
-            averaged_polarity = np.mean(polarities_data[mask], axis=0)
-            averaged_polarities.append(averaged_polarity)
-        else:
-            averaged_polarities.append(np.ones_like(polarities_data[0]) * 128)
+    averaged_polarities = {}
+    group_sum = None
+    group_count = 0
+    current_group = -1
+    offset = 0
+    for polarities in tqdm.tqdm(reader.iter_polarity_chunks(arrs, CHUNK_SIZE)):
+        groups = polarity_groups[offset : offset + len(polarities)]
+        offset += len(polarities)
+        boundaries = np.flatnonzero(np.diff(groups)) + 1
+        for group, group_polarities in zip(
+            groups[np.r_[0, boundaries]], np.split(polarities, boundaries)
+        ):
+            if group != current_group:
+                if group_sum is not None and current_group < len(frames_data):
+                    averaged_polarities[current_group] = (
+                        group_sum / group_count
+                    ).astype(np.uint8)
+                group_sum = np.zeros(group_polarities.shape[1:], dtype=np.float64)
+                group_count = 0
+                current_group = group
+            group_sum += group_polarities.sum(axis=0)
+            group_count += len(group_polarities)
+    if group_sum is not None and current_group < len(frames_data):
+        averaged_polarities[current_group] = (group_sum / group_count).astype(np.uint8)
 
-    del polarities_data, polarity_groups
+    del polarity_groups
+    neutral_polarity = np.ones_like(group_sum, dtype=np.uint8) * 128
 
-    averaged_polarities = np.array(averaged_polarities, dtype=np.uint8)
     fourcc = cv2.VideoWriter_fourcc(*"mp4v")  # type: ignore
 
     logging.info(f"Saving video as {output_file}...")
     out = cv2.VideoWriter(str(output_file), fourcc, 60.0, (346, 260 * 2), 0)
 
-    for frame, polarity in tqdm.tqdm(
-        zip(frames_data, averaged_polarities), total=len(frames_data)
-    ):
+    for i, frame in tqdm.tqdm(enumerate(frames_data), total=len(frames_data)):
+        polarity = averaged_polarities.get(i)
+        if polarity is None:
+            polarity = neutral_polarity
         frame = frame.astype(np.uint8)
         frame = np.vstack([frame, polarity])
         out.write(frame)
@@ -8,6 +8,8 @@ import pathlib
 import cv2  # type: ignore
 import numpy as np  # type: ignore
 
+import reader
+
 logging.basicConfig(
     level=logging.INFO, format="%(asctime)s - %(levelname)s - %(message)s"
 )
@@ -18,6 +20,7 @@ class Config:
     input_bin: pathlib.Path
     input_vid: pathlib.Path
     output: pathlib.Path
+    pack_polarities: bool
 
     @classmethod
     def from_args(cls):
@@ -38,6 +41,12 @@ class Config:
             help="Path to the output file",
             default="output.npz",
         )
+        args.add_argument(
+            "--pack-polarities",
+            action="store_true",
+            help="Store polarity frames packed at 2 bits per pixel",
+            default=False,
+        )
         return cls(**vars(args.parse_args()))
 
 
@@ -88,9 +97,13 @@ if __name__ == "__main__":
 
     out_data = {
         "polarity_groups": polarity_groups.astype(np.uint16),
-        "polarity_data": polarity_data,
         "frame_data": frames,
     }
+    if config.pack_polarities:
+        out_data["polarity_packed"] = reader.pack_polarities(polarity_data)
+        out_data["polarity_shape"] = np.array((height, width), dtype=np.uint32)
+    else:
+        out_data["polarity_data"] = polarity_data
     logging.info(f"Saving data to {config.output}")
     np.savez_compressed(config.output, **out_data)
     logging.info("DONE!")
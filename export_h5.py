@@ -6,17 +6,24 @@ import enum
 import logging
 import pathlib
 import struct
+import time
+from typing import Iterator
 
 import h5py
 import numpy as np
 import tqdm
 import tqdm.contrib.logging
 
+import reader
+
 logging.basicConfig(
     level=logging.INFO, format="%(asctime)s - %(levelname)s - %(message)s"
 )
 
 IMAGE_SHAPE = (260, 346)
+POLL_INTERVAL = 0.5
+IDLE_TIMEOUT = 30.0
+MAX_ROWS_PER_POLL = 256
 
 
 class EventType(enum.IntEnum):
@@ -75,10 +82,70 @@ PARSERS = {
 }
 
 
+def parse_event(i: int, event: np.void) -> tuple[EventHeader, ParsedEvent] | None:
+    sys_ts, header, body = event
+    try:
+        parsed_header = EventHeader.from_buffer(header)
+    except struct.error:
+        logging.error(f"Failed to parse event {i+1} header - skipping.")
+        return None
+    parser = PARSERS.get(parsed_header.type)
+    if parser is None:
+        logging.debug(
+            f"Unknown event type: {parsed_header.type} - skipping event {i+1}."
+        )
+        return None
+    return parsed_header, parser(body, parsed_header)
+
+
+def open_source(path: pathlib.Path, tail: bool) -> h5py.File:
+    if tail:
+        return h5py.File(path, "r", libver="latest", swmr=True)
+    return h5py.File(path, "r")
+
+
+def read_new_rows(path: pathlib.Path, offset: int) -> np.ndarray | None:
+    # Variable-length packet bodies live outside of the metadata refreshed by
+    # SWMR, so the file is reopened on every poll to see the flushed heap.
+    try:
+        with open_source(path, tail=True) as source:
+            dvs_data = source["dvs"]["data"]  # type: ignore
+            return dvs_data[offset : offset + MAX_ROWS_PER_POLL]  # type: ignore
+    except (OSError, KeyError) as e:
+        logging.debug(f"Rows from {offset} not readable yet: {e}")
+        return None
+
+
+def tail_events(
+    path: pathlib.Path, poll_interval: float, idle_timeout: float
+) -> Iterator[tuple[int, np.ndarray]]:
+    offset = 0
+    last_update = time.monotonic()
+    while True:
+        rows = read_new_rows(path, offset)
+        if rows is not None and len(rows) > 0:
+            last_update = time.monotonic()
+            yield offset, rows
+            offset += len(rows)
+            if len(rows) == MAX_ROWS_PER_POLL:
+                # More rows may already be available - read them right away.
+                continue
+        elif time.monotonic() - last_update > idle_timeout:
+            logging.info(f"No new events for {idle_timeout}s - stopping.")
+            return
+        else:
+            yield offset, np.empty(0, dtype=object)
+        time.sleep(poll_interval)
+
+
 @dataclasses.dataclass
 class Config:
     input: pathlib.Path
     output: pathlib.Path
+    pack_polarities: bool
+    tail: bool
+    poll_interval: float
+    idle_timeout: float
 
     @classmethod
     def from_args(cls):
@@ -94,6 +161,30 @@ class Config:
             help="Path to the output file",
             default="output.npz",
         )
+        args.add_argument(
+            "--pack-polarities",
+            action="store_true",
+            help="Store polarity frames packed at 2 bits per pixel",
+            default=False,
+        )
+        args.add_argument(
+            "--tail",
+            action="store_true",
+            help="Follow a recording that is still being written (HDF5 SWMR mode)",
+            default=False,
+        )
+        args.add_argument(
+            "--poll-interval",
+            type=float,
+            help="Seconds between checks for new events in tail mode",
+            default=POLL_INTERVAL,
+        )
+        args.add_argument(
+            "--idle-timeout",
+            type=float,
+            help="Seconds without new events after which tail mode stops",
+            default=IDLE_TIMEOUT,
+        )
         return cls(**vars(args.parse_args()))
 
 
@@ -101,7 +192,7 @@ if __name__ == "__main__":
     config = Config.from_args()
 
     try:
-        source = h5py.File(config.input, "r")
+        source = open_source(config.input, config.tail)
     except OSError:
         logging.error(f"Failed to open {config.input} - exiting.")
         exit(1)
@@ -112,22 +203,28 @@ if __name__ == "__main__":
         EventType.FRAME: {"timestamps": [], "data": []},
         EventType.POLARITY: {"timestamps": [], "data": []},
     }
-    total_events = len(dvs_data)  # type: ignore
-    for i, event in tqdm.tqdm(enumerate(dvs_data), total=total_events):  # type: ignore
+    if config.tail:
+        logging.info("Following the recording until it stops growing...")
+        source.close()
+        total_events = None
+        events = (
+            (offset + j, row)
+            for offset, rows in tail_events(
+                config.input, config.poll_interval, config.idle_timeout
+            )
+            for j, row in enumerate(rows)
+        )
+    else:
+        total_events = len(dvs_data)  # type: ignore
+        events = enumerate(dvs_data)  # type: ignore
+    for i, event in tqdm.tqdm(events, total=total_events):
         with tqdm.contrib.logging.logging_redirect_tqdm():
-            sys_ts, header, body = event
-            try:
-                parsed_header = EventHeader.from_buffer(header)
-            except struct.error:
-                logging.error(f"Failed to parse event {i+1} header - skipping.")
-                continue
-            parser = PARSERS.get(parsed_header.type)
-            if parser is None:
-                logging.debug(
-                    f"Unknown event type: {parsed_header.type} - skipping event {i+1}."
-                )
+            parsed = parse_event(i, event)
+            if parsed is None:
                 continue
-            event = parser(body, parsed_header)
+            parsed_header, event = parsed
+            if config.pack_polarities and parsed_header.type == EventType.POLARITY:
+                event.data = reader.pack_polarities(event.data)
             event_aggregates[parsed_header.type]["timestamps"].append(event.timestamp)
             event_aggregates[parsed_header.type]["data"].append(event.data)
 
@@ -149,9 +246,13 @@ if __name__ == "__main__":
     assert max_groups < 2**16, "Too many groups for uint16."
     out_data = {
         "polarity_groups": polarity_groups.astype(np.uint16),
-        "polarity_data": event_aggregates[EventType.POLARITY]["data"],
         "frame_data": event_aggregates[EventType.FRAME]["data"],
     }
+    if config.pack_polarities:
+        out_data["polarity_packed"] = event_aggregates[EventType.POLARITY]["data"]
+        out_data["polarity_shape"] = np.array(IMAGE_SHAPE, dtype=np.uint32)
+    else:
+        out_data["polarity_data"] = event_aggregates[EventType.POLARITY]["data"]
     del event_aggregates
     logging.info(f"Saving data to {config.output}")
     np.savez_compressed(config.output, **out_data)
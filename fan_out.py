@@ -0,0 +1,221 @@
+from __future__ import annotations
+
+import argparse
+import dataclasses
+import logging
+import pathlib
+
+import cv2
+import numpy as np
+import tqdm
+
+import reader
+from voxelize_and_batch import (
+    BATCH_SIZE,
+    CHUNK_SIZE,
+    T_H,
+    T_W,
+    ShardWriter,
+    normalize_polarities,
+    trim,
+    voxelize_group,
+)
+
+logging.basicConfig(
+    level=logging.INFO, format="%(asctime)s - %(levelname)s - %(message)s"
+)
+
+VIDEO_FPS = 60.0
+VIDEO_SIZE = (346, 260 * 2)
+
+
+class VideoConsumer:
+    def __init__(self, output_file: pathlib.Path) -> None:
+        fourcc = cv2.VideoWriter_fourcc(*"mp4v")  # type: ignore
+        self.out = cv2.VideoWriter(str(output_file), fourcc, VIDEO_FPS, VIDEO_SIZE, 0)
+
+    def consume(
+        self,
+        index: int,
+        frame: np.ndarray,
+        polarities: np.ndarray,
+        normalized: np.ndarray | None,
+    ) -> None:
+        if len(polarities) > 0:
+            polarity = np.mean(polarities, axis=0).astype(np.uint8)
+        else:
+            polarity = np.ones(polarities.shape[1:], dtype=np.uint8) * 128
+        self.out.write(np.vstack([frame.astype(np.uint8), polarity]))
+
+    def close(self) -> None:
+        self.out.release()
+
+
+class VoxelConsumer:
+    def __init__(self, writer: ShardWriter, n_bins: int, b_size: int) -> None:
+        self.writer = writer
+        self.n_bins = n_bins
+        self.b_size = b_size
+        self.target_times = np.linspace(0, 1, n_bins)
+
+    def consume(
+        self,
+        index: int,
+        frame: np.ndarray,
+        polarities: np.ndarray,
+        normalized: np.ndarray | None,
+    ) -> None:
+        voxel = np.zeros((self.n_bins, T_H, T_W), dtype=np.float16)
+        if len(polarities) > 0:
+            voxel = voxelize_group(normalized, self.target_times)  # type: ignore
+        self.writer.add(trim(frame), voxel)
+        if len(self.writer) >= self.b_size:
+            self.writer.flush()
+
+    def close(self) -> None:
+        self.writer.flush()
+        if self.writer.quantize:
+            logging.info(
+                f"Quantized {self.n_bins}-bin voxels - max error: {self.writer.max_error:.6f}, bound: {self.writer.max_bound:.6f}"
+            )
+
+
+class HistogramConsumer:
+    def __init__(self, output_dir: pathlib.Path, name: str, b_size: int) -> None:
+        self.output_dir = output_dir
+        self.name = name
+        self.b_size = b_size
+        self.shard = 0
+        self.histograms = []
+
+    def consume(
+        self,
+        index: int,
+        frame: np.ndarray,
+        polarities: np.ndarray,
+        normalized: np.ndarray | None,
+    ) -> None:
+        histogram = np.stack(
+            [np.sum(normalized == 1, axis=0), np.sum(normalized == -1, axis=0)]
+        )
+        self.histograms.append(histogram.astype(np.uint16))
+        if len(self.histograms) >= self.b_size:
+            self.flush()
+
+    def flush(self) -> None:
+        if not self.histograms:
+            return
+        np.savez(
+            self.output_dir / f"{self.name}_{self.shard:>04}.npz",
+            histogram_data=np.array(self.histograms),
+        )
+        self.shard += 1
+        self.histograms = []
+
+    def close(self) -> None:
+        self.flush()
+
+
+@dataclasses.dataclass
+class Config:
+    input: pathlib.Path
+    video: pathlib.Path | None
+    voxel_output: pathlib.Path | None
+    histogram_output: pathlib.Path | None
+    num_bins: list[int]
+    batch_size: int
+    quantize: bool
+
+    @classmethod
+    def from_args(cls):
+        args = argparse.ArgumentParser()
+        args.add_argument(
+            "--input",
+            type=pathlib.Path,
+            help="Path to the input file",
+            required=True,
+        )
+        args.add_argument(
+            "--video",
+            type=pathlib.Path,
+            help="Path to the output video file",
+        )
+        args.add_argument(
+            "--voxel-output",
+            type=pathlib.Path,
+            help="Path to the output directory of the voxelized batches",
+        )
+        args.add_argument(
+            "--histogram-output",
+            type=pathlib.Path,
+            help="Path to the output directory of the event count histograms",
+        )
+        args.add_argument(
+            "--num-bins",
+            type=int,
+            nargs="+",
+            help="Numbers of bins to use for the voxelization",
+            default=[6],
+        )
+        args.add_argument(
+            "--batch-size",
+            type=int,
+            default=BATCH_SIZE,
+        )
+        args.add_argument(
+            "--quantize",
+            action="store_true",
+            help="Store voxels as int8 with per-bin scale factors",
+            default=False,
+        )
+        return cls(**vars(args.parse_args()))
+
+
+if __name__ == "__main__":
+    config = Config.from_args()
+    name = config.input.stem
+
+    consumers = []
+    if config.video is not None:
+        config.video.parent.mkdir(parents=True, exist_ok=True)
+        consumers.append(VideoConsumer(config.video))
+    if config.voxel_output is not None:
+        for n_bins in config.num_bins:
+            output_dir = config.voxel_output
+            if len(config.num_bins) > 1:
+                output_dir = output_dir / f"bins_{n_bins}"
+            output_dir.mkdir(parents=True, exist_ok=True)
+            writer = ShardWriter(output_dir, name, config.quantize)
+            consumers.append(VoxelConsumer(writer, n_bins, config.batch_size))
+    if config.histogram_output is not None:
+        config.histogram_output.mkdir(parents=True, exist_ok=True)
+        consumers.append(
+            HistogramConsumer(config.histogram_output, name, config.batch_size)
+        )
+    needs_normalized = any(
+        isinstance(consumer, (VoxelConsumer, HistogramConsumer))
+        for consumer in consumers
+    )
+    if not consumers:
+        logging.error("No outputs requested - exiting.")
+        exit(1)
+    logging.info(f"Producing {len(consumers)} outputs from {config.input}.")
+
+    frame = None
+    polarities = None
+    with reader.ZipNumpyReader(config.input) as npz_file:
+        num_frames = npz_file.get_metadata("frame_data")["shape"][0]
+        for index, frame, polarities in tqdm.tqdm(
+            reader.iter_frame_groups(npz_file, CHUNK_SIZE), total=num_frames
+        ):
+            # Trimmed and normalized once, shared by every voxel and histogram output.
+            normalized = None
+            if needs_normalized:
+                normalized = normalize_polarities(polarities)
+            for consumer in consumers:
+                consumer.consume(index, frame, polarities, normalized)
+        del frame, polarities
+
+    for consumer in consumers:
+        consumer.close()
+    logging.info("Done!")
@@ -0,0 +1,261 @@
+from __future__ import annotations
+
+import json
+import logging
+import os
+import pathlib
+import threading
+import time
+import uuid
+
+LEASE_TTL = 600.0
+HEARTBEAT_INTERVAL = 60.0
+READ_ATTEMPTS = 5
+READ_RETRY_DELAY = 0.2
+
+
+class LeaseLost(Exception):
+    pass
+
+
+def worker_item(worker_id: str) -> str:
+    # Held by a worker for as long as it runs, next to the leases of its items.
+    return f"worker-{worker_id}"
+
+
+def write_json_atomic(path: pathlib.Path, data: dict) -> None:
+    tmp_path = path.with_name(f".{path.name}.{uuid.uuid4().hex}.tmp")
+    with open(tmp_path, "w") as f:
+        json.dump(data, f)
+    os.replace(tmp_path, path)
+
+
+class LeaseManager:
+    def __init__(
+        self,
+        work_dir: pathlib.Path,
+        worker_id: str,
+        ttl: float = LEASE_TTL,
+        heartbeat_interval: float = HEARTBEAT_INTERVAL,
+    ) -> None:
+        self.lease_dir = work_dir / "leases"
+        self.result_dir = work_dir / "results"
+        self.failure_dir = work_dir / "failures"
+        self.lease_dir.mkdir(parents=True, exist_ok=True)
+        self.result_dir.mkdir(parents=True, exist_ok=True)
+        self.failure_dir.mkdir(parents=True, exist_ok=True)
+        self.worker_id = worker_id
+        self.ttl = ttl
+        self.heartbeat_interval = heartbeat_interval
+        self.held = {}
+        self.refreshed = {}
+        self.lock = threading.Lock()
+        self.stopped = threading.Event()
+        self.heartbeat = threading.Thread(target=self._heartbeat_loop, daemon=True)
+
+    def __enter__(self):
+        self.heartbeat.start()
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.stopped.set()
+        self.heartbeat.join()
+        for item_id in list(self.held):
+            self.release(item_id)
+
+    def _lease_file(self, item_id: str) -> pathlib.Path:
+        return self.lease_dir / f"{item_id}.lease"
+
+    def _create(self, item_id: str) -> bool:
+        token = uuid.uuid4().hex
+        try:
+            fd = os.open(
+                self._lease_file(item_id), os.O_CREAT | os.O_EXCL | os.O_WRONLY
+            )
+        except OSError:
+            # Also covers Windows refusing to recreate a file pending deletion.
+            return False
+        with os.fdopen(fd, "w") as f:
+            json.dump({"worker": self.worker_id, "token": token}, f)
+        with self.lock:
+            self.held[item_id] = token
+            self.refreshed[item_id] = time.time()
+        return True
+
+    def _expired(self, path: pathlib.Path) -> bool:
+        try:
+            return time.time() - path.stat().st_mtime > self.ttl
+        except OSError:
+            return False
+
+    def _read_token(self, item_id: str) -> str | None:
+        try:
+            with open(self._lease_file(item_id), "r") as f:
+                return json.load(f)["token"]
+        except (OSError, json.JSONDecodeError, KeyError):
+            return None
+
+    def _owns(self, item_id: str) -> bool:
+        token = self._read_token(item_id)
+        return token is not None and token == self.held.get(item_id)
+
+    def _lose(self, item_id: str) -> None:
+        logging.warning(f"Lost the lease of {item_id}.")
+        with self.lock:
+            self.held.pop(item_id, None)
+            self.refreshed.pop(item_id, None)
+
+    def _restore(self, stale_file: pathlib.Path, lease_file: pathlib.Path) -> None:
+        try:
+            os.link(stale_file, lease_file)
+        except FileExistsError:
+            pass
+        except OSError:
+            # Hard links are not available on every filesystem (e.g. SMB shares).
+            try:
+                if not lease_file.exists():
+                    os.rename(stale_file, lease_file)
+                    return
+            except OSError as e:
+                logging.warning(f"Failed to restore lease {lease_file}: {e}")
+                return
+        try:
+            stale_file.unlink()
+        except OSError:
+            pass
+
+    def _steal(self, item_id: str) -> bool:
+        lease_file = self._lease_file(item_id)
+        stale_file = lease_file.with_name(f"{lease_file.name}.{uuid.uuid4().hex}")
+        try:
+            # Only one worker can move a given lease file away.
+            os.rename(lease_file, stale_file)
+        except OSError:
+            return False
+        if not self._expired(stale_file):
+            # Another worker re-claimed the lease in the meantime - put it back.
+            self._restore(stale_file, lease_file)
+            return False
+        try:
+            stale_file.unlink()
+        except OSError:
+            pass
+        logging.info(f"Stole expired lease of {item_id}.")
+        return self._create(item_id)
+
+    def holds(self, item_id: str) -> bool:
+        with self.lock:
+            token = self.held.get(item_id)
+        if token is None:
+            return False
+        current = self._read_token(item_id)
+        if current is not None and current != token:
+            self._lose(item_id)
+            return False
+        return True
+
+    def ensure_held(self, item_id: str) -> None:
+        if not self.holds(item_id):
+            raise LeaseLost(f"Lost the lease of {item_id}.")
+
+    def _read_json(self, path: pathlib.Path) -> dict | None:
+        try:
+            with open(path, "r") as f:
+                return json.load(f)
+        except FileNotFoundError:
+            return None
+        except json.JSONDecodeError:
+            logging.warning(f"Skipping unreadable {path}.")
+            return None
+
+    def is_done(self, item_id: str) -> bool:
+        result = self._read_json(self.result_dir / f"{item_id}.json")
+        return result is not None and result.get("status") == "done"
+
+    def attempts(self, item_id: str) -> int:
+        failure = self._read_json(self.failure_dir / f"{item_id}.json")
+        return 0 if failure is None else failure.get("attempts", 0)
+
+    def try_claim(self, item_id: str) -> bool:
+        if self.is_done(item_id):
+            return False
+        if not self._create(item_id):
+            if not self._expired(self._lease_file(item_id)):
+                return False
+            if not self._steal(item_id):
+                return False
+        if self.is_done(item_id):
+            # Finished by the previous holder right before its lease expired.
+            self.release(item_id)
+            return False
+        return True
+
+    def release(self, item_id: str) -> None:
+        if self._owns(item_id):
+            try:
+                self._lease_file(item_id).unlink()
+            except OSError as e:
+                logging.warning(f"Failed to remove the lease of {item_id}: {e}")
+        with self.lock:
+            self.held.pop(item_id, None)
+            self.refreshed.pop(item_id, None)
+
+    def record_result(self, item_id: str, result: dict) -> None:
+        write_json_atomic(
+            self.result_dir / f"{item_id}.json",
+            {"worker": self.worker_id, **result},
+        )
+
+    def record_failure(self, item_id: str, error: str) -> int:
+        # Only the lease holder writes here, so the counter needs no extra locking.
+        attempts = self.attempts(item_id) + 1
+        write_json_atomic(
+            self.failure_dir / f"{item_id}.json",
+            {"worker": self.worker_id, "attempts": attempts, "error": error},
+        )
+        return attempts
+
+    def merge_results(self) -> dict[str, dict]:
+        results = {}
+        for result_file in sorted(self.result_dir.glob("*.json")):
+            result = self._read_json(result_file)
+            if result is not None and result.get("status") == "done":
+                results[result_file.stem] = result
+        return results
+
+    def _refresh(self, item_id: str) -> None:
+        # The lease file can briefly disappear while another worker checks it
+        # for expiry, so a missing file is retried rather than treated as lost.
+        token = None
+        for _ in range(READ_ATTEMPTS):
+            token = self._read_token(item_id)
+            if token is not None:
+                break
+            time.sleep(READ_RETRY_DELAY)
+        with self.lock:
+            expected = self.held.get(item_id)
+            refreshed = self.refreshed.get(item_id, 0.0)
+        if expected is None:
+            return
+        if token is None:
+            if time.time() - refreshed > self.ttl:
+                self._lose(item_id)
+            return
+        if token != expected:
+            self._lose(item_id)
+            return
+        try:
+            os.utime(self._lease_file(item_id))
+        except OSError as e:
+            logging.debug(f"Failed to refresh the lease of {item_id}: {e}")
+            return
+        with self.lock:
+            if item_id in self.held:
+                self.refreshed[item_id] = time.time()
+
+    def _heartbeat_loop(self) -> None:
+        while not self.stopped.wait(self.heartbeat_interval):
+            with self.lock:
+                held = list(self.held)
+            for item_id in held:
+                self._refresh(item_id)
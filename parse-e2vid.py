@@ -67,6 +67,7 @@ if __name__ == "__main__":
                 str(extracted_file),
                 "--output",
                 str(exported_file),
+                "--pack-polarities",
             ],
             check=True,
             text=True,
@@ -1,12 +1,20 @@
+import argparse
+import functools
 import json
 import logging
+import os
 import pathlib
+import shutil
+import socket
 import subprocess
-import sys
+import time
+from typing import Callable
 
 import gdown
 import patoolib
 
+import leases
+
 logging.basicConfig(
     level=logging.INFO, format="%(asctime)s - %(levelname)s - %(message)s"
 )
@@ -16,6 +24,136 @@ URL_TEMPLATE = "https://drive.google.com/uc?id={}"
 VID_OUT_FOLDER = pathlib.Path("videos")
 PREPROCESSED_OUT_FOLDER = pathlib.Path("../out/")
 NAME_MAPPING_FILE = "names.json"
+MAX_ATTEMPTS = 3
+WORKER_FILE = ".worker.json"
+
+
+def clear_tmp_dir(tmp_dir: pathlib.Path) -> None:
+    for file in tmp_dir.glob("*"):
+        if file.is_file() and file.name != WORKER_FILE:
+            file.unlink()
+
+
+def remove_stale_worker_dirs(
+    lease_manager: leases.LeaseManager, work_dir: pathlib.Path
+) -> None:
+    for worker_dir in TMP_DIR.iterdir():
+        if worker_dir.name == lease_manager.worker_id:
+            continue
+        try:
+            with open(worker_dir / WORKER_FILE, "r") as f:
+                owner = json.load(f)
+        except (OSError, json.JSONDecodeError):
+            continue
+        if owner.get("work_dir") != str(work_dir.resolve()):
+            continue
+        # Holding the worker's own lease guarantees it is not running anymore.
+        worker_item = leases.worker_item(worker_dir.name)
+        if not lease_manager.try_claim(worker_item):
+            continue
+        try:
+            logging.info(f"Removing leftovers of stopped worker {worker_dir.name}")
+            shutil.rmtree(worker_dir, ignore_errors=True)
+        finally:
+            lease_manager.release(worker_item)
+
+
+def process_recording(
+    file_id: str,
+    tmp_dir: pathlib.Path,
+    py_interpreter: str,
+    preprocess_flag: bool,
+    fan_out_flag: bool,
+    check: Callable[[], None] = lambda: None,
+) -> str:
+    url = URL_TEMPLATE.format(file_id)
+
+    archive_file = tmp_dir / f"{file_id}.7z"
+    exported_file = tmp_dir / f"{file_id}.npz"
+    output_file = VID_OUT_FOLDER / f"{file_id}.mp4"
+
+    if not archive_file.exists():
+        gdown.download(url, output=str(tmp_dir / f"{file_id}.7z"), quiet=False)
+
+    logging.info(f"Extracting {file_id} to {tmp_dir}")
+    patoolib.extract_archive(
+        str(archive_file), outdir=str(tmp_dir), verbosity=1, interactive=False
+    )
+    archive_file.unlink()
+    extracted_file = list(tmp_dir.glob("*.hdf5"))[0]
+    check()
+
+    logging.info("Starting export process".center(80, "="))
+    subprocess.run(
+        [
+            py_interpreter,
+            "-u",
+            "export_h5.py",
+            "--input",
+            str(extracted_file),
+            "--output",
+            str(exported_file),
+            "--pack-polarities",
+        ],
+        check=True,
+        text=True,
+    )
+
+    logging.info(f"Exported {file_id} to {exported_file}")
+    extracted_file.unlink()
+    check()
+    if fan_out_flag:
+        logging.info("Starting fan-out process".center(80, "="))
+        subprocess.run(
+            [
+                py_interpreter,
+                "-u",
+                "fan_out.py",
+                "--input",
+                str(exported_file),
+                "--video",
+                str(output_file),
+                "--voxel-output",
+                str(PREPROCESSED_OUT_FOLDER),
+            ],
+            check=True,
+            text=True,
+        )
+        logging.info(f"Converted and preprocessed {file_id}")
+    elif preprocess_flag:
+        logging.info("Starting preprocessing".center(80, "="))
+        subprocess.run(
+            [
+                py_interpreter,
+                "-u",
+                "voxelize_and_batch.py",
+                "--input",
+                str(exported_file),
+                "--output",
+                str(PREPROCESSED_OUT_FOLDER),
+            ],
+            check=True,
+            text=True,
+        )
+        logging.info(f"Preprocessed {file_id}")
+    else:
+        logging.info("Starting conversion process".center(80, "="))
+        subprocess.run(
+            [
+                py_interpreter,
+                "-u",
+                "convert_to_video.py",
+                "--input",
+                str(exported_file),
+                "--output",
+                str(output_file),
+            ],
+            check=True,
+            text=True,
+        )
+        logging.info(f"Converted {file_id} to videos/{file_id}.mp4")
+    exported_file.unlink()
+    return extracted_file.stem
 
 
 if __name__ == "__main__":
@@ -27,21 +165,67 @@ if __name__ == "__main__":
         logging.info("No virtual environment found, using system python")
         py_interpreter = "python"
 
-    for file in TMP_DIR.glob("*"):
-        file.unlink()
+    parser = argparse.ArgumentParser()
+    parser.add_argument("ids", type=pathlib.Path, help="Path to the ids file")
+    parser.add_argument(
+        "preprocess",
+        nargs="?",
+        default="",
+        help="Run in preprocessing mode instead of video extraction (any value)",
+    )
+    parser.add_argument(
+        "--fan-out",
+        action="store_true",
+        help="Produce both the video and the preprocessed data in a single pass",
+        default=False,
+    )
+    parser.add_argument(
+        "--work-dir",
+        type=pathlib.Path,
+        help="Shared directory for leases and results - enables distributed mode",
+    )
+    parser.add_argument(
+        "--worker-id",
+        type=str,
+        help="Unique name of this worker in distributed mode",
+        default=f"{socket.gethostname()}-{os.getpid()}",
+    )
+    parser.add_argument(
+        "--lease-ttl",
+        type=float,
+        help="Seconds without a heartbeat after which a lease can be stolen",
+        default=leases.LEASE_TTL,
+    )
+    parser.add_argument(
+        "--heartbeat-interval",
+        type=float,
+        help="Seconds between lease heartbeats in distributed mode",
+        default=leases.HEARTBEAT_INTERVAL,
+    )
+    parser.add_argument(
+        "--max-attempts",
+        type=int,
+        help="Failed attempts after which a recording is skipped in distributed mode",
+        default=MAX_ATTEMPTS,
+    )
+    args = parser.parse_args()
 
-    if len(sys.argv) < 2:
-        logging.error("Please provide a path to the ids file")
-        sys.exit(1)
+    ids_path = args.ids
+    preprocess_flag = bool(args.preprocess)
+    fan_out_flag = args.fan_out
+    mode = "preprocessing" if preprocess_flag else "video extraction"
+    if fan_out_flag:
+        mode = "fan-out"
+    logging.info(f"Script run in {mode} mode")
 
-    ids_path = sys.argv[1]
-    preprocess_flag = bool(sys.argv[2]) if len(sys.argv) > 2 else False
-    logging.info(
-        f"Script run in {'video extraction' if not preprocess_flag else 'preprocessing'} mode"
-    )
+    tmp_dir = TMP_DIR
+    if args.work_dir is None:
+        clear_tmp_dir(tmp_dir)
 
     name_mapping_file = (
-        VID_OUT_FOLDER if not preprocess_flag else PREPROCESSED_OUT_FOLDER
+        VID_OUT_FOLDER
+        if not preprocess_flag or fan_out_flag
+        else PREPROCESSED_OUT_FOLDER
     ) / "names.json"
     name_mapping = {}
 
@@ -54,79 +238,87 @@ if __name__ == "__main__":
 
     logging.info(f"Loaded {len(ids)} ids from {ids_path}")
 
-    for file_id in ids:
-        url = URL_TEMPLATE.format(file_id)
+    if args.work_dir is None:
+        for file_id in ids:
+            output_file = VID_OUT_FOLDER / f"{file_id}.mp4"
+            if output_file.exists() or name_mapping.get(file_id):
+                logging.info(f"Skipping {file_id} - already exists")
+                continue
 
-        archive_file = TMP_DIR / f"{file_id}.7z"
-        exported_file = TMP_DIR / f"{file_id}.npz"
-        output_file = VID_OUT_FOLDER / f"{file_id}.mp4"
+            name_mapping[file_id] = process_recording(
+                file_id, tmp_dir, py_interpreter, preprocess_flag, fan_out_flag
+            )
+            with open(name_mapping_file, "w") as f:
+                json.dump(name_mapping, f)
+    else:
+        with leases.LeaseManager(
+            args.work_dir, args.worker_id, args.lease_ttl, args.heartbeat_interval
+        ) as lease_manager:
+            if not lease_manager.try_claim(leases.worker_item(args.worker_id)):
+                logging.error(f"Worker id {args.worker_id} is in use - exiting.")
+                exit(1)
+            logging.info(f"Running as distributed worker {args.worker_id}")
+            remove_stale_worker_dirs(lease_manager, args.work_dir)
+            tmp_dir = TMP_DIR / args.worker_id
+            tmp_dir.mkdir(parents=True, exist_ok=True)
+            clear_tmp_dir(tmp_dir)
+            leases.write_json_atomic(
+                tmp_dir / WORKER_FILE, {"work_dir": str(args.work_dir.resolve())}
+            )
 
-        if output_file.exists() or name_mapping.get(file_id):
-            logging.info(f"Skipping {file_id} - already exists")
-            continue
+            pending = [file_id for file_id in ids if not name_mapping.get(file_id)]
+            while pending:
+                remaining = []
+                for file_id in pending:
+                    attempts = lease_manager.attempts(file_id)
+                    if attempts >= args.max_attempts:
+                        logging.warning(
+                            f"Skipping {file_id} - failed {attempts} times already"
+                        )
+                        continue
+                    if not lease_manager.try_claim(file_id):
+                        if not lease_manager.is_done(file_id):
+                            remaining.append(file_id)
+                        continue
 
-        if not archive_file.exists():
-            gdown.download(url, output=str(TMP_DIR / f"{file_id}.7z"), quiet=False)
+                    logging.info(f"Claimed {file_id}")
+                    try:
+                        name = process_recording(
+                            file_id,
+                            tmp_dir,
+                            py_interpreter,
+                            preprocess_flag,
+                            fan_out_flag,
+                            functools.partial(lease_manager.ensure_held, file_id),
+                        )
+                        lease_manager.ensure_held(file_id)
+                        lease_manager.record_result(
+                            file_id, {"status": "done", "name": name}
+                        )
+                    except leases.LeaseLost:
+                        logging.warning(
+                            f"Abandoning {file_id} - its lease was taken over"
+                        )
+                    except Exception as e:
+                        attempts = lease_manager.record_failure(file_id, str(e))
+                        logging.exception(
+                            f"Failed to process {file_id} (attempt {attempts})"
+                        )
+                        remaining.append(file_id)
+                    finally:
+                        lease_manager.release(file_id)
+                        clear_tmp_dir(tmp_dir)
 
-        logging.info(f"Extracting {file_id} to {TMP_DIR}")
-        patoolib.extract_archive(
-            str(archive_file), outdir=str(TMP_DIR), verbosity=1, interactive=False
-        )
-        archive_file.unlink()
-        extracted_file = list(TMP_DIR.glob("*.hdf5"))[0]
-        name_mapping[file_id] = extracted_file.stem
-        with open(name_mapping_file, "w") as f:
-            json.dump(name_mapping, f)
+                    for result_id, result in lease_manager.merge_results().items():
+                        if result["status"] == "done":
+                            name_mapping[result_id] = result["name"]
+                    leases.write_json_atomic(name_mapping_file, name_mapping)
 
-        logging.info("Starting export process".center(80, "="))
-        subprocess.run(
-            [
-                py_interpreter,
-                "-u",
-                "export_h5.py",
-                "--input",
-                str(extracted_file),
-                "--output",
-                str(exported_file),
-            ],
-            check=True,
-            text=True,
-        )
-
-        logging.info(f"Exported {file_id} to {exported_file}")
-        extracted_file.unlink()
-        if preprocess_flag:
-            logging.info("Starting preprocessing".center(80, "="))
-            subprocess.run(
-                [
-                    py_interpreter,
-                    "-u",
-                    "voxelize_and_batch.py",
-                    "--input",
-                    str(exported_file),
-                    "--output",
-                    str(PREPROCESSED_OUT_FOLDER),
-                ],
-                check=True,
-                text=True,
-            )
-            logging.info(f"Preprocessed {file_id}")
-        else:
-            logging.info("Starting conversion process".center(80, "="))
-            subprocess.run(
-                [
-                    py_interpreter,
-                    "-u",
-                    "convert_to_video.py",
-                    "--input",
-                    str(exported_file),
-                    "--output",
-                    str(output_file),
-                ],
-                check=True,
-                text=True,
-            )
-            logging.info(f"Converted {file_id} to videos/{file_id}.mp4")
-        exported_file.unlink()
+                pending = remaining
+                if pending:
+                    logging.info(
+                        f"Waiting for {len(pending)} ids leased elsewhere or to retry"
+                    )
+                    time.sleep(args.heartbeat_interval)
 
     logging.info("Done".center(80, "="))
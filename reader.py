@@ -1,9 +1,67 @@
 import logging
+import pathlib
 import tempfile
 import zipfile
 
 import numpy as np
 
+POLARITY_VALUES = np.array([0, 127, 255, 127], dtype=np.uint8)
+POLARITY_SHIFTS = np.array([0, 2, 4, 6], dtype=np.uint8)
+
+
+def pack_polarities(polarities: np.ndarray) -> np.ndarray:
+    codes = (polarities >= 127).astype(np.uint8) + (polarities > 127)
+    codes = codes.reshape(*polarities.shape[:-2], -1)
+    padding = -codes.shape[-1] % 4
+    if padding:
+        pad_width = [(0, 0)] * (codes.ndim - 1) + [(0, padding)]
+        codes = np.pad(codes, pad_width, constant_values=1)
+    codes = codes.reshape(*codes.shape[:-1], -1, 4)
+    return codes[..., 0] | codes[..., 1] << 2 | codes[..., 2] << 4 | codes[..., 3] << 6
+
+
+def unpack_polarities(packed: np.ndarray, shape: tuple[int, int]) -> np.ndarray:
+    codes = packed[..., None] >> POLARITY_SHIFTS & 0b11
+    values = POLARITY_VALUES[codes].reshape(*packed.shape[:-1], -1)
+    values = values[..., : shape[0] * shape[1]]
+    return values.reshape(*packed.shape[:-1], *shape)
+
+
+def voxel_scale(voxels: np.ndarray) -> np.ndarray:
+    bin_axis = voxels.ndim - 3
+    axes = tuple(axis for axis in range(voxels.ndim) if axis != bin_axis)
+    return (np.abs(voxels).max(axis=axes) / 127).astype(np.float32)
+
+
+def quantize_voxels(voxels: np.ndarray, scale: np.ndarray) -> np.ndarray:
+    scale = np.maximum(scale, np.finfo(np.float32).tiny)[:, None, None]
+    return np.clip(np.rint(voxels / scale), -127, 127).astype(np.int8)
+
+
+def dequantize_voxels(quantized: np.ndarray, scale: np.ndarray) -> np.ndarray:
+    return quantized.astype(np.float32) * scale[:, None, None]
+
+
+def load_batch(batch_file: str | pathlib.Path) -> tuple[np.ndarray, np.ndarray]:
+    with np.load(batch_file) as arrs:
+        voxels = arrs["polarity_data"]
+        if "polarity_scale" in arrs.files:
+            voxels = dequantize_voxels(voxels, arrs["polarity_scale"])
+        return arrs["frame_data"], voxels
+
+
+def iter_polarity_chunks(arrs: np.lib.npyio.NpzFile, chunk_size: int):
+    if "polarity_packed" not in arrs.files:
+        polarities = arrs["polarity_data"]
+        for offset in range(0, len(polarities), chunk_size):
+            yield polarities[offset : offset + chunk_size]
+        return
+
+    packed = arrs["polarity_packed"]
+    shape = tuple(int(dim) for dim in arrs["polarity_shape"])
+    for offset in range(0, len(packed), chunk_size):
+        yield unpack_polarities(packed[offset : offset + chunk_size], shape)
+
 
 class NumpyMemmapIterator:
     def __init__(
@@ -42,6 +100,20 @@ class NumpyMemmapIterator:
         return chunk_array
 
 
+class PackedPolarityIterator:
+    def __init__(
+        self, packed_iterator: NumpyMemmapIterator, shape: tuple[int, int]
+    ) -> None:
+        self.packed_iterator = packed_iterator
+        self.shape = shape
+
+    def __iter__(self):
+        return self
+
+    def __next__(self) -> np.ndarray:
+        return unpack_polarities(next(self.packed_iterator), self.shape)
+
+
 class ZipNumpyReader:
     def __init__(self, input_file: str) -> None:
         self.input_file = input_file
@@ -79,8 +151,127 @@ class ZipNumpyReader:
             self.array_metadata[f"{arr_name}.npy"]["shape"],
         )
 
+    def get_polarity_iterator(
+        self, chunk_size: int
+    ) -> NumpyMemmapIterator | PackedPolarityIterator:
+        if "polarity_packed.npy" not in self.array_metadata:
+            return self.get_iterator("polarity_data", chunk_size)
+        shape = tuple(int(dim) for dim in self.get_array("polarity_shape"))
+        return PackedPolarityIterator(
+            self.get_iterator("polarity_packed", chunk_size), shape  # type: ignore
+        )
+
     def get_array(self, arr_name: str) -> np.ndarray:
         return np.load(f"{self.tmp_dir.name}\\{arr_name}.npy")
 
     def get_metadata(self, arr_name: str) -> dict:
         return self.array_metadata[f"{arr_name}.npy"]
+
+
+class RowStream:
+    def __init__(self, chunks) -> None:
+        self.chunks = iter(chunks)
+        self.chunk = None
+        self.position = 0
+
+    def take(self, count: int) -> list[np.ndarray]:
+        pieces = []
+        while count > 0:
+            if self.chunk is None or self.position >= len(self.chunk):
+                self.chunk = next(self.chunks)
+                self.position = 0
+            piece = self.chunk[self.position : self.position + count]
+            self.position += len(piece)
+            count -= len(piece)
+            pieces.append(piece)
+        return pieces
+
+
+def iter_frame_groups(npz_file: ZipNumpyReader, chunk_size: int):
+    polarity_groups = npz_file.get_array("polarity_groups")
+    num_frames = npz_file.get_metadata("frame_data")["shape"][0]
+    bounds = np.searchsorted(polarity_groups, np.arange(num_frames + 1))
+    polarities = RowStream(npz_file.get_polarity_iterator(chunk_size))
+    frame_index = 0
+    for frames in npz_file.get_iterator("frame_data", chunk_size):
+        for frame in frames:
+            pieces = polarities.take(int(bounds[frame_index + 1] - bounds[frame_index]))
+            if not pieces:
+                group = np.empty((0, *frame.shape[:2]), dtype=np.uint8)
+            elif len(pieces) == 1:
+                group = pieces[0]
+            else:
+                group = np.concatenate(pieces)
+            yield frame_index, frame, group
+            frame_index += 1
+
+
+def build_sequence_index(
+    num_frames: int, sequence_length: int, sequence_stride: int
+) -> np.ndarray:
+    starts = np.arange(0, num_frames - sequence_length + 1, sequence_stride)
+    return np.stack([starts, starts + sequence_length], axis=1).astype(np.int64)
+
+
+def load_sequence_params(
+    store_dir: pathlib.Path, name: str, index: np.ndarray
+) -> tuple[int | None, int | None]:
+    params_file = store_dir / f"{name}_sequence.npy"
+    if params_file.exists():
+        length, stride = np.load(params_file)
+        return int(length), int(stride)
+    # Stores written before the parameters were saved - infer what the index allows.
+    length = int(index[0, 1] - index[0, 0]) if len(index) > 0 else None
+    stride = int(index[1, 0] - index[0, 0]) if len(index) > 1 else None
+    return length, stride
+
+
+class SequenceStoreReader:
+    def __init__(
+        self,
+        store_dir: str | pathlib.Path,
+        name: str,
+        sequence_length: int | None = None,
+        sequence_stride: int | None = None,
+    ) -> None:
+        store_dir = pathlib.Path(store_dir)
+        self.frames = np.load(store_dir / f"{name}_frames.npy", mmap_mode="r")
+        self.voxels = np.load(store_dir / f"{name}_voxels.npy", mmap_mode="r")
+        self.index = np.load(store_dir / f"{name}_index.npy")
+        self.voxel_scale = None
+        scale_file = store_dir / f"{name}_voxel_scale.npy"
+        if scale_file.exists():
+            self.voxel_scale = np.load(scale_file)
+        if sequence_length is not None or sequence_stride is not None:
+            stored_length, stored_stride = load_sequence_params(
+                store_dir, name, self.index
+            )
+            if sequence_length is None:
+                sequence_length = stored_length
+            if sequence_stride is None:
+                sequence_stride = stored_stride
+            if sequence_length is None or sequence_stride is None:
+                raise ValueError(
+                    f"Store {name} does not record its sequence length and stride - pass both"
+                )
+            if sequence_length <= 0 or sequence_stride <= 0:
+                raise ValueError("Sequence length and stride must be positive")
+            self.index = build_sequence_index(
+                len(self.frames), sequence_length, sequence_stride
+            )
+        logging.debug(
+            f"Opened store {name} with {len(self.frames)} frames and {len(self.index)} sequences"
+        )
+
+    def __len__(self) -> int:
+        return len(self.index)
+
+    def __getitem__(self, idx: int) -> tuple[np.ndarray, np.ndarray]:
+        start, stop = self.index[idx]
+        return self.frames[start:stop], self.voxels[start:stop]
+
+    def get_dequantized(self, idx: int) -> tuple[np.ndarray, np.ndarray]:
+        frames, voxels = self[idx]
+        if self.voxel_scale is None:
+            return frames, voxels
+        return frames, dequantize_voxels(voxels, self.voxel_scale)
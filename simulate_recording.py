@@ -0,0 +1,155 @@
+from __future__ import annotations
+
+import argparse
+import dataclasses
+import logging
+import pathlib
+import struct
+import time
+
+import h5py
+import numpy as np
+
+from export_h5 import IMAGE_SHAPE, EventType
+
+logging.basicConfig(
+    level=logging.INFO, format="%(asctime)s - %(levelname)s - %(message)s"
+)
+
+HEADER_FORMAT = "hhiiiiii"
+DVS_DTYPE = np.dtype(
+    [
+        ("sys_ts", np.int64),
+        ("header", f"V{struct.calcsize(HEADER_FORMAT)}"),
+        ("data", h5py.vlen_dtype(np.uint8)),
+    ]
+)
+
+
+def build_header(etype: EventType, size: int, capacity: int) -> np.void:
+    header = struct.pack(
+        HEADER_FORMAT,
+        etype,
+        1,
+        size,
+        struct.calcsize(HEADER_FORMAT),
+        0,
+        capacity,
+        capacity,
+        capacity,
+    )
+    return np.void(header)
+
+
+def build_frame_body(img: np.ndarray, timestamp_us: int) -> np.ndarray:
+    sub_header = np.zeros(9, dtype=np.uint32)
+    sub_header[2] = timestamp_us
+    pixels = img[::-1, ::-1].astype(np.uint16) * 256
+    return np.frombuffer(sub_header.tobytes() + pixels.tobytes(), dtype=np.uint8)
+
+
+def build_polarity_body(
+    xs: np.ndarray, ys: np.ndarray, pols: np.ndarray, timestamp_us: int
+) -> np.ndarray:
+    events = np.zeros((len(xs), 2), dtype=np.uint32)
+    events[:, 0] = pols.astype(np.uint32) << 1 | ys.astype(np.uint32) << 2
+    events[:, 0] |= xs.astype(np.uint32) << 17
+    events[:, 1] = timestamp_us
+    return events.view(np.uint8).reshape(-1)
+
+
+@dataclasses.dataclass
+class Config:
+    output: pathlib.Path
+    frames: int
+    fps: float
+    packets_per_frame: int
+    events_per_packet: int
+    seed: int
+
+    @classmethod
+    def from_args(cls):
+        args = argparse.ArgumentParser()
+        args.add_argument(
+            "--output",
+            type=pathlib.Path,
+            help="Path to the output hdf5 file",
+            default="synthetic.hdf5",
+        )
+        args.add_argument(
+            "--frames",
+            type=int,
+            help="Number of frames to write",
+            default=100,
+        )
+        args.add_argument(
+            "--fps",
+            type=float,
+            help="Number of frames written per second",
+            default=20.0,
+        )
+        args.add_argument(
+            "--packets-per-frame",
+            type=int,
+            help="Number of polarity packets written between two frames",
+            default=4,
+        )
+        args.add_argument(
+            "--events-per-packet",
+            type=int,
+            help="Number of polarity events in a single packet",
+            default=2000,
+        )
+        args.add_argument(
+            "--seed",
+            type=int,
+            help="Seed of the random generator",
+            default=0,
+        )
+        return cls(**vars(args.parse_args()))
+
+
+if __name__ == "__main__":
+    config = Config.from_args()
+    rng = np.random.default_rng(config.seed)
+    height, width = IMAGE_SHAPE
+    frame_interval_us = int(1e6 / config.fps)
+
+    target = h5py.File(config.output, "w", libver="latest")
+    dvs_data = target.create_group("dvs").create_dataset(
+        "data", shape=(0,), maxshape=(None,), dtype=DVS_DTYPE, chunks=(64,)
+    )
+    target.swmr_mode = True
+    logging.info(f"Writing {config.frames} frames to {config.output} in SWMR mode.")
+
+    rows = 0
+    for i in range(config.frames):
+        frame_ts = (i + 1) * frame_interval_us
+        packet_step = frame_interval_us // config.packets_per_frame
+        packets = []
+        for j in range(config.packets_per_frame):
+            n_events = config.events_per_packet
+            body = build_polarity_body(
+                rng.integers(0, width, n_events),
+                rng.integers(0, height, n_events),
+                rng.integers(0, 2, n_events),
+                i * frame_interval_us + (j + 1) * packet_step,
+            )
+            header = build_header(EventType.POLARITY, 8, n_events)
+            packets.append((time.time_ns(), header, body))
+
+        img = rng.integers(0, 256, IMAGE_SHAPE, dtype=np.uint8)
+        body = build_frame_body(img, frame_ts)
+        packets.append(
+            (time.time_ns(), build_header(EventType.FRAME, len(body), 1), body)
+        )
+
+        dvs_data.resize((rows + len(packets),))
+        for packet in packets:
+            dvs_data[rows] = packet
+            rows += 1
+        target.flush()
+        time.sleep(1 / config.fps)
+
+    target.close()
+    logging.info(f"Wrote {rows} packets.")
@@ -1,11 +1,14 @@
 import argparse
 import logging
 import pathlib
+import time
+from typing import Iterator
 
 import tqdm
 import numpy as np
 import scipy.interpolate  # type: ignore
 
+import export_h5
 import reader
 
 
@@ -21,6 +24,163 @@ OFFSET_W = (S_W - T_W) // 2
 
 CHUNK_SIZE = 8192
 BATCH_SIZE = 128
+SEQUENCE_LENGTH = 16
+SEQUENCE_STRIDE = 1
+MAX_LATENCY = 5.0
+
+
+def trim(data: np.ndarray) -> np.ndarray:
+    return data[..., OFFSET_H : S_H - OFFSET_H, OFFSET_W : S_W - OFFSET_W]
+
+
+def normalize_polarities(polarities: np.ndarray) -> np.ndarray:
+    polarities = trim(polarities).astype(np.float16)
+    return (polarities - 127.5) / 127.5
+
+
+def voxelize_group(polarities: np.ndarray, target_times: np.ndarray) -> np.ndarray:
+    if len(polarities) == 1:
+        return np.repeat(polarities, len(target_times), axis=0)
+    original_times = np.linspace(0, 1, len(polarities))
+    interpolator = scipy.interpolate.interp1d(
+        original_times, polarities, kind="linear", axis=0
+    )
+    return interpolator(target_times)
+
+
+def voxelize_chunks(
+    polarities_iter, polarity_groups: np.ndarray, target_times: np.ndarray
+) -> Iterator[tuple[int, np.ndarray]]:
+    prev_group = -1
+    arr_offset = 0
+    for i, polarities in enumerate(polarities_iter):
+        polarities = normalize_polarities(polarities)
+        groups = polarity_groups[arr_offset : arr_offset + len(polarities)]
+        logging.debug(
+            f"Groups: {groups[:10]}...{groups[-10:]}, Offset:{arr_offset} - {arr_offset + len(polarities)}"
+        )
+        arr_offset += len(polarities)
+        min_group = np.min(groups)
+        prev_group = np.max(groups)
+        group_range = range(min_group, prev_group + 1)
+        logging.info(
+            f"Processing polarities - chunk {i+1:>3}. - polarities: {len(polarities):>10} (frames {min_group} - {prev_group})"
+        )
+
+        for i in tqdm.tqdm(
+            group_range, desc="Voxelizing polarities", total=len(group_range)
+        ):
+            if i == prev_group:
+                continue
+
+            mask = groups == i
+            if not np.any(mask):
+                continue
+
+            yield i, voxelize_group(polarities[mask], target_times)
+
+
+def save_batch(
+    output_file: pathlib.Path, frames: np.ndarray, voxels: np.ndarray, quantize: bool
+) -> tuple[float, float]:
+    batch_data = {"frame_data": frames, "polarity_data": voxels}
+    max_error, bound = 0.0, 0.0
+    if quantize:
+        scale = reader.voxel_scale(voxels)
+        quantized = reader.quantize_voxels(voxels, scale)
+        error = np.abs(reader.dequantize_voxels(quantized, scale) - voxels)
+        max_error, bound = float(error.max(initial=0)), float(scale.max() / 2)
+        batch_data["polarity_data"] = quantized
+        batch_data["polarity_scale"] = scale
+    np.savez(output_file, **batch_data)
+    return max_error, bound
+
+
+class ShardWriter:
+    def __init__(self, output_dir: pathlib.Path, name: str, quantize: bool) -> None:
+        self.output_dir = output_dir
+        self.name = name
+        self.quantize = quantize
+        self.shard = 0
+        self.frames = []
+        self.voxels = []
+        self.first_added = 0.0
+        self.max_error = 0.0
+        self.max_bound = 0.0
+
+    def __len__(self) -> int:
+        return len(self.frames)
+
+    def add(self, frame: np.ndarray, voxel: np.ndarray) -> None:
+        if not self.frames:
+            self.first_added = time.monotonic()
+        self.frames.append(frame)
+        self.voxels.append(voxel)
+
+    def pending_for(self) -> float:
+        if not self.frames:
+            return 0.0
+        return time.monotonic() - self.first_added
+
+    def flush(self) -> None:
+        if not self.frames:
+            return
+        output_file = self.output_dir / f"{self.name}_{self.shard:>04}.npz"
+        logging.info(f"Saving {len(self.frames)} frames to {output_file}")
+        error, bound = save_batch(
+            output_file,
+            np.array(self.frames, dtype=np.uint8),
+            np.array(self.voxels, dtype=np.float16),
+            self.quantize,
+        )
+        self.max_error = max(self.max_error, error)
+        self.max_bound = max(self.max_bound, bound)
+        self.shard += 1
+        self.frames = []
+        self.voxels = []
+
+
+def voxelize_tail(
+    input_file: pathlib.Path,
+    writer: ShardWriter,
+    n_bins: int,
+    b_size: int,
+    poll_interval: float,
+    idle_timeout: float,
+    max_latency: float,
+) -> None:
+    target_times = np.linspace(0, 1, n_bins)
+    polarity_timestamps = []
+    polarities = []
+    num_frames = 0
+    for offset, rows in export_h5.tail_events(input_file, poll_interval, idle_timeout):
+        for i, row in enumerate(rows, offset):
+            parsed = export_h5.parse_event(i, row)
+            if parsed is None:
+                continue
+            header, event = parsed
+            if header.type == export_h5.EventType.POLARITY:
+                polarity_timestamps.append(event.timestamp)
+                polarities.append(event.data)
+                continue
+
+            group_size = np.searchsorted(
+                polarity_timestamps, event.timestamp, side="right"
+            )
+            voxel = np.zeros((n_bins, T_H, T_W), dtype=np.float16)
+            if group_size > 0:
+                group = normalize_polarities(np.array(polarities[:group_size]))
+                voxel = voxelize_group(group, target_times)
+            del polarities[:group_size], polarity_timestamps[:group_size]
+            writer.add(trim(event.data), voxel)
+            num_frames += 1
+            if len(writer) >= b_size or writer.pending_for() > max_latency:
+                writer.flush()
+        # Also covers polls without new frames.
+        if writer.pending_for() > max_latency:
+            writer.flush()
+    writer.flush()
+    logging.info(f"Voxelized {num_frames} frames in {writer.shard} batches.")
 
 
 if __name__ == "__main__":
@@ -53,8 +213,58 @@ if __name__ == "__main__":
         type=int,
         default=BATCH_SIZE,
     )
+    parser.add_argument(
+        "--quantize",
+        action="store_true",
+        help="Store voxels as int8 with per-bin scale factors",
+        default=False,
+    )
+    parser.add_argument(
+        "--sequence-store",
+        action="store_true",
+        help="Write the recording as a single memory-mappable store with a sequence index instead of batches",
+        default=False,
+    )
+    parser.add_argument(
+        "--sequence-length",
+        type=int,
+        default=SEQUENCE_LENGTH,
+        help="Number of frames in a single sequence of the store index",
+    )
+    parser.add_argument(
+        "--sequence-stride",
+        type=int,
+        default=SEQUENCE_STRIDE,
+        help="Number of frames between starts of consecutive sequences of the store index",
+    )
+    parser.add_argument(
+        "--tail",
+        action="store_true",
+        help="Voxelize an .hdf5 recording that is still being written (HDF5 SWMR mode)",
+        default=False,
+    )
+    parser.add_argument(
+        "--poll-interval",
+        type=float,
+        default=export_h5.POLL_INTERVAL,
+        help="Seconds between checks for new events in tail mode",
+    )
+    parser.add_argument(
+        "--idle-timeout",
+        type=float,
+        default=export_h5.IDLE_TIMEOUT,
+        help="Seconds without new events after which tail mode stops",
+    )
+    parser.add_argument(
+        "--max-latency",
+        type=float,
+        default=MAX_LATENCY,
+        help="Maximum seconds a voxelized frame waits before its batch is saved in tail mode",
+    )
 
     args = parser.parse_args()
+    if args.sequence_length <= 0 or args.sequence_stride <= 0:
+        parser.error("--sequence-length and --sequence-stride must be positive")
     input_file = args.input
     output_dir = args.output
     n_bins = args.num_bins
@@ -72,61 +282,80 @@ if __name__ == "__main__":
     logging.debug(f"Number of bins: {n_bins}")
     logging.debug(f"Chunk size: {CHUNK_SIZE}")
 
+    if args.tail:
+        if args.sequence_store:
+            logging.error("Sequence store is not supported in tail mode - exiting.")
+            exit(1)
+        writer = ShardWriter(output_dir, input_file.stem, args.quantize)
+        voxelize_tail(
+            input_file,
+            writer,
+            n_bins,
+            b_size,
+            args.poll_interval,
+            args.idle_timeout,
+            args.max_latency,
+        )
+        if args.quantize:
+            logging.info(
+                f"Quantized voxels - max error: {writer.max_error:.6f}, bound: {writer.max_bound:.6f}"
+            )
+        logging.info("Data saved successfully.")
+        exit(0)
+
     target_times = np.linspace(0, 1, n_bins)
     frames = None
     polarities = None
     with reader.ZipNumpyReader(input_file) as npz_file:
         frames_iter = npz_file.get_iterator("frame_data", CHUNK_SIZE)
-        polarities_iter = npz_file.get_iterator("polarity_data", CHUNK_SIZE)
+        polarities_iter = npz_file.get_polarity_iterator(CHUNK_SIZE)
         polarity_groups = npz_file.get_array("polarity_groups")
-        num_frames = polarity_groups.max() + 1
+        num_frames = int(polarity_groups.max()) + 1
         logging.info(f"Found {num_frames} frames in the input file.")
         num_polarities = len(polarity_groups)
         logging.info(f"Found {num_polarities} polarities in the input file.")
 
-        voxelled_polarities = np.zeros((num_frames, n_bins, T_H, T_W), dtype=np.float16)
-        trimmed_frames = np.zeros((num_frames, T_H, T_W), dtype=np.uint8)
-        logging.info(f"Loaded {input_file} successfully.")
-        logging.info("Processing data in chunks...")
-        prev_group = -1
-        arr_offset = 0
-        for i, polarities in enumerate(polarities_iter):
-            polarities = polarities[
-                :, OFFSET_H : S_H - OFFSET_H, OFFSET_W : S_W - OFFSET_W
-            ].astype(np.float16)
-            polarities = (polarities - 127.5) / 127.5
-            groups = polarity_groups[arr_offset : arr_offset + len(polarities)]
-            logging.debug(
-                f"Groups: {groups[:10]}...{groups[-10:]}, Offset:{arr_offset} - {arr_offset + len(polarities)}"
+        if args.sequence_store:
+            voxelled_polarities = np.lib.format.open_memmap(
+                output_dir / f"{input_file.stem}_voxels.npy",
+                mode="w+",
+                dtype=np.int8 if args.quantize else np.float16,
+                shape=(num_frames, n_bins, T_H, T_W),
             )
-            arr_offset += len(polarities)
-            min_group = np.min(groups)
-            prev_group = np.max(groups)
-            group_range = range(min_group, prev_group + 1)
-            logging.info(
-                f"Processing polarities - chunk {i+1:>3}. - polarities: {len(polarities):>10} (frames {min_group} - {prev_group})"
+            trimmed_frames = np.lib.format.open_memmap(
+                output_dir / f"{input_file.stem}_frames.npy",
+                mode="w+",
+                dtype=np.uint8,
+                shape=(num_frames, T_H, T_W),
             )
-
-            for i in tqdm.tqdm(
-                group_range, desc="Voxelizing polarities", total=len(group_range)
+        else:
+            voxelled_polarities = np.zeros(
+                (num_frames, n_bins, T_H, T_W), dtype=np.float16
+            )
+            trimmed_frames = np.zeros((num_frames, T_H, T_W), dtype=np.uint8)
+        logging.info(f"Loaded {input_file} successfully.")
+        logging.info("Processing data in chunks...")
+        if args.sequence_store and args.quantize:
+            # Scale first, so the voxels can be quantized as they are produced.
+            scale = np.zeros(n_bins, dtype=np.float32)
+            for _, voxel in voxelize_chunks(
+                npz_file.get_polarity_iterator(CHUNK_SIZE),
+                polarity_groups,
+                target_times,
             ):
-                if i == prev_group:
-                    continue
-
-                mask = groups == i
-                if not np.any(mask):
-                    continue
-
-                polarities_chunk = polarities[mask]
-                if len(polarities_chunk) == 1:
-                    voxel = np.repeat(polarities_chunk, n_bins, axis=0)
-                else:
-                    original_times = np.linspace(0, 1, np.sum(mask))
-                    interpolator = scipy.interpolate.interp1d(
-                        original_times, polarities_chunk, kind="linear", axis=0
-                    )
-                    voxel = interpolator(target_times)
-                voxelled_polarities[i] = voxel
+                scale = np.maximum(scale, reader.voxel_scale(voxel.astype(np.float16)))
+            max_error = 0.0
+        for index, voxel in voxelize_chunks(
+            polarities_iter, polarity_groups, target_times
+        ):
+            if args.sequence_store and args.quantize:
+                voxel = voxel.astype(np.float16)
+                quantized = reader.quantize_voxels(voxel, scale)
+                voxelled_polarities[index] = quantized
+                error = np.abs(reader.dequantize_voxels(quantized, scale) - voxel)
+                max_error = max(max_error, float(error.max(initial=0)))
+            else:
+                voxelled_polarities[index] = voxel
 
         for i, frames in enumerate(frames_iter):
             logging.info(
@@ -135,21 +364,48 @@ if __name__ == "__main__":
             left = i * CHUNK_SIZE
             right = left + len(frames)
             logging.debug(f"Frames: {left} - {right}")
-            trimmed_frames[left:right] = frames[
-                :, OFFSET_H : S_H - OFFSET_H, OFFSET_W : S_W - OFFSET_W
-            ]
+            trimmed_frames[left:right] = trim(frames)
         logging.debug("Cleaning up memmapped arrays")
         del polarities
         del frames
 
-    n_batches, rem_batches = divmod(num_frames, b_size)
-    n_batches += bool(rem_batches)
-
-    logging.info(f"Saving data to {output_dir} in {n_batches} batches...")
-    for i in tqdm.tqdm(range(0, len(voxelled_polarities), b_size)):
-        np.savez(
-            output_dir / f"{input_file.stem}_{i // b_size:>04}.npz",
-            frame_data=trimmed_frames[i : i + b_size],
-            polarity_data=voxelled_polarities[i : i + b_size],
+    if args.sequence_store:
+        sequence_index = reader.build_sequence_index(
+            num_frames, args.sequence_length, args.sequence_stride
+        )
+        logging.info(
+            f"Saving store to {output_dir} with {len(sequence_index)} sequences..."
+        )
+        trimmed_frames.flush()
+        voxelled_polarities.flush()
+        if args.quantize:
+            logging.info(
+                f"Quantized voxels - max error: {max_error:.6f}, bound: {scale.max() / 2:.6f}"
+            )
+            np.save(output_dir / f"{input_file.stem}_voxel_scale.npy", scale)
+        np.save(output_dir / f"{input_file.stem}_index.npy", sequence_index)
+        np.save(
+            output_dir / f"{input_file.stem}_sequence.npy",
+            np.array([args.sequence_length, args.sequence_stride], dtype=np.int64),
         )
+    else:
+        n_batches, rem_batches = divmod(num_frames, b_size)
+        n_batches += bool(rem_batches)
+
+        logging.info(f"Saving data to {output_dir} in {n_batches} batches...")
+        max_error = 0.0
+        max_bound = 0.0
+        for i in tqdm.tqdm(range(0, len(voxelled_polarities), b_size)):
+            error, bound = save_batch(
+                output_dir / f"{input_file.stem}_{i // b_size:>04}.npz",
+                trimmed_frames[i : i + b_size],
+                voxelled_polarities[i : i + b_size],
+                args.quantize,
+            )
+            max_error = max(max_error, error)
+            max_bound = max(max_bound, bound)
+        if args.quantize:
+            logging.info(
+                f"Quantized voxels - max error: {max_error:.6f}, bound: {max_bound:.6f}"
+            )
     logging.info("Data saved successfully.")